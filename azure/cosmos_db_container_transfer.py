@@ -1,64 +1,269 @@
 """Simple script to move data from one Cosmos DB container to another.
 
 - Ok for small to medium-sized data transfer tasks
+- Source pages are read while earlier items are still being upserted (producer/consumer queue)
 - For moving records in 100k+ range, consider using Azure Data Factory or other bulk data transfer tools
+
+Requires: pip install azure-cosmos aiohttp tqdm  (azure.cosmos.aio needs aiohttp)
 """
+import asyncio
+import contextlib
+import json
+import logging
 import os
+import random
 import time
 from tqdm import tqdm
-from azure.cosmos import CosmosClient, exceptions, PartitionKey
+from tqdm.contrib.logging import logging_redirect_tqdm
+from azure.cosmos import exceptions, PartitionKey
+from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+from azure.cosmos.aio import CosmosClient
 
-# Initialize Cosmos Client
-source_client = CosmosClient.from_connection_string(os.environ["COSMOS_CONNECTION_STRING__SOURCE"])
-target_client = CosmosClient.from_connection_string(os.environ["COSMOS_CONNECTION_STRING__TARGET"])
+logger = logging.getLogger(__name__)
 
 # Source Database and Container
 source_database_id = 'MyDB'
 source_container_id = 'MyBaseContainer'
-source_database = source_client.get_database_client(source_database_id)
-source_container = source_database.get_container_client(source_container_id)
 
 # Destination Database and Container
 destination_database_id = 'MyDB'
 destination_container_id = 'MyBaseContainer'
-destination_database = target_client.create_database_if_not_exists(destination_database_id)
-destination_container = destination_database.create_container_if_not_exists(destination_container_id, PartitionKey(path="/id"))
 
 # Query to fetch all items in the source container
-# Modify the query as per your requirement
+# Modify the query as per your requirement, e.g. "SELECT c.id, c.name FROM c" to only move the fields you need
 query = "SELECT * FROM c"
 
-max_retries = 5
-initial_wait_time = 5  # seconds
-page_no = 0
+# Server-maintained properties, regenerated by the destination on write
+system_properties = ('_rid', '_self', '_etag', '_attachments', '_ts')
+
+# Throttled upserts are retried until this much time has passed for the item (the SDK's default max wait)
+retry_deadline = 30  # seconds
+backoff_base = 0.05  # seconds
+backoff_cap = 1.0  # seconds, cap of a single jittered wait
+
+# Concurrency is capped at what the destination RU/s can absorb, and at what the transport can run:
+# aiohttp's default connector holds at most 100 connections, extra requests would just queue there
+provisioned_ru = 10000  # RU/s of the destination container
+avg_ru_per_write = 10  # check the x-ms-request-charge of a typical upsert
+connection_pool_size = 100
+max_concurrency = max(1, min(provisioned_ru // avg_ru_per_write, connection_pool_size))
+success_streak = 10  # successful writes needed before concurrency is raised again
+
+# Producer/consumer settings
+num_workers = max_concurrency
+queue_size = 4000  # caps how far the source read can run ahead of the writes
+
+# Page numbers and continuation tokens of fully transferred pages, so a rerun resumes where it stopped.
+# Tokens are only valid for the same query; delete the file after changing it.
+checkpoint_file = f"{source_container_id}.checkpoint"
 
-def upsert_with_retry(item, max_retries, initial_wait_time):
+
+class AdaptiveLimiter:
+    """Caps in-flight upserts; halves on throttling and grows back by one after a streak of successes.
+
+    Requests that started before the last cut are still in flight when throttling begins, so their
+    429s belong to the same episode and do not cut the limit again.
+    """
+
+    def __init__(self, max_limit, success_streak):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.success_streak = success_streak
+        self.in_flight = 0
+        self.successes = 0
+        self.epoch = 0  # bumped on every cut
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            started_epoch = self.epoch
+        throttled = succeeded = False
+        try:
+            yield
+            succeeded = True
+        except exceptions.CosmosHttpResponseError as e:
+            throttled = e.status_code == 429
+            raise
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()  # a slot was freed
+                if throttled and started_epoch == self.epoch:
+                    self.limit = max(1, self.limit // 2)
+                    self.successes = 0
+                    self.epoch += 1
+                elif succeeded:
+                    self.successes += 1
+                    if self.successes >= self.success_streak and self.limit < self.max_limit:
+                        self.limit += 1
+                        self.successes = 0
+                        self._condition.notify()
+
+
+def get_retry_delay(error, retries, base, cap):
+    """Server-suggested wait when Cosmos sends one, otherwise full-jitter exponential backoff."""
+    retry_after_ms = (error.headers or {}).get("x-ms-retry-after-ms")
+    if retry_after_ms:
+        return float(retry_after_ms) / 1000
+    return random.uniform(0, min(cap, base * 2 ** min(retries, 16)))
+
+
+async def upsert_with_retry(container, item, limiter, retry_deadline, backoff_base, backoff_cap):
+    """Returns (transferred, retries) for the item."""
     retries = 0
-    wait_time = initial_wait_time
-    while retries < max_retries:
+    deadline = time.monotonic() + retry_deadline
+    while True:
         try:
-            destination_container.upsert_item(item)
-            print(f"Item with id {item['id']} transferred successfully.")
-            return True
+            async with limiter.slot():
+                await container.upsert_item(item)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Item with id %s transferred successfully.", item['id'])
+            return True, retries
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error occurred while transferring item with id {item['id']}. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-            wait_time *= 2  # Simulate exponential backoff
+            if e.status_code != 429:
+                logger.error("Failed to transfer item with id %s: %s %s", item['id'], e.status_code, e.message)
+                return False, retries
+            wait_time = get_retry_delay(e, retries, backoff_base, backoff_cap)
+            if time.monotonic() + wait_time > deadline:  # no point waiting if the next attempt would be too late
+                logger.error("Failed to transfer item with id %s, still throttled after %d attempts.", item['id'], retries + 1)
+                return False, retries
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Throttled while transferring item with id %s. Retrying in %.3f seconds...", item['id'], wait_time)
+            await asyncio.sleep(wait_time)
             retries += 1
-    print(f"Failed to transfer item with id {item['id']} after {max_retries} attempts.")
-    return False
-
-for page in source_container.query_items(
-        query=query,
-        max_item_count=1000,
-        enable_cross_partition_query=True).by_page():
-    page_no += 1
-    print(f"[START] Processing page {page_no}")
-    print("-" * 50)
-
-    for item in tqdm(page, desc=f"Transferring items from PAGE {page_no}"):
-      upsert_with_retry(item, max_retries, initial_wait_time)
-
-    print("-" * 50)
-    print(f"[END] Processing page {page_no}")
-    print()
+
+
+def read_checkpoint(path):
+    """Returns (page_no, continuation_token) of the last committed page, or (0, None)."""
+    if not os.path.exists(path):
+        return 0, None
+    with open(path, "r+") as f:
+        content = f.read()
+        # A crash mid-append leaves a partial last line; drop it so new checkpoints start on a fresh line
+        if not content.endswith("\n"):
+            content = content[:content.rfind("\n") + 1]
+            f.truncate(len(content.encode()))
+    # Fall back to the last line that still parses
+    for line in reversed(content.splitlines()):
+        try:
+            checkpoint = json.loads(line)
+            return checkpoint["page"], checkpoint["continuation"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring unreadable checkpoint line in %s", path)
+    return 0, None
+
+
+def write_checkpoint(path, page_no, continuation_token):
+    with open(path, "a") as f:
+        f.write(json.dumps({"page": page_no, "continuation": continuation_token}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+async def main():
+    source_connection_string = os.environ["COSMOS_CONNECTION_STRING__SOURCE"]
+    target_connection_string = os.environ["COSMOS_CONNECTION_STRING__TARGET"]
+
+    # Source reads and destination setup keep the SDK's default throttle retries
+    async with CosmosClient.from_connection_string(target_connection_string, connection_verify=True) as setup_client:
+        destination_database = await setup_client.create_database_if_not_exists(destination_database_id)
+        await destination_database.create_container_if_not_exists(destination_container_id, PartitionKey(path="/id"))
+
+    # Throttled upserts are retried by upsert_with_retry, so the writing client has the SDK's throttle retries switched off.
+    # Passed as a policy since retry_total=0 would fall back to the SDK default.
+    target_policy = ConnectionPolicy()
+    target_policy.RetryOptions = RetryOptions(max_retry_attempt_count=0)
+
+    async with CosmosClient.from_connection_string(source_connection_string, connection_verify=True) as source_client, \
+            CosmosClient.from_connection_string(target_connection_string, connection_verify=True, connection_policy=target_policy) as target_client:
+        source_database = source_client.get_database_client(source_database_id)
+        source_container = source_database.get_container_client(source_container_id)
+
+        destination_database = target_client.get_database_client(destination_database_id)
+        destination_container = destination_database.get_container_client(destination_container_id)
+
+        queue = asyncio.Queue(maxsize=queue_size)
+        limiter = AdaptiveLimiter(max_concurrency, success_streak)
+        progress = tqdm(desc="Transferring items", unit="item")
+
+        start_page, start_continuation = read_checkpoint(checkpoint_file)
+        page_stats = {}
+        completed_pages = {}
+        next_page_to_commit = start_page + 1
+        failed_items = 0
+        checkpoint_lock = asyncio.Lock()
+
+        async def finish_page(page_no):
+            """Checkpoint the latest page whose predecessors have all been transferred too.
+
+            A page with failed items is never committed, so a rerun starts from it again.
+            """
+            nonlocal next_page_to_commit, failed_items
+            stats = page_stats.pop(page_no)
+            logger.info("page %d: %d ok, %d retried, %d failed", page_no, stats["ok"], stats["retried"], stats["failed"])
+            failed_items += stats["failed"]
+            completed_pages[page_no] = stats
+            # Held across the write so checkpoints land in page order
+            async with checkpoint_lock:
+                committed_page, continuation = None, None
+                while next_page_to_commit in completed_pages and completed_pages[next_page_to_commit]["failed"] == 0:
+                    committed_page = next_page_to_commit
+                    continuation = completed_pages.pop(next_page_to_commit)["continuation"]
+                    next_page_to_commit += 1
+                if continuation:
+                    await asyncio.to_thread(write_checkpoint, checkpoint_file, committed_page, continuation)
+
+        async def produce():
+            page_no = start_page
+            if start_continuation:
+                logger.info("Resuming after page %d from checkpoint in %s", start_page, checkpoint_file)
+            pages = source_container.query_items(query=query, max_item_count=1000).by_page(start_continuation)
+            async for page in pages:
+                page_no += 1
+                items = [item async for item in page]
+                page_stats[page_no] = dict(pending=len(items), ok=0, retried=0, failed=0, continuation=pages.continuation_token)
+                if not items:
+                    await finish_page(page_no)
+                for item in items:
+                    for key in system_properties:
+                        item.pop(key, None)
+                    await queue.put((page_no, item))
+            for _ in range(num_workers):
+                await queue.put(None)  # sentinel, one per worker
+
+        async def consume():
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                page_no, item = entry
+                transferred, retries = await upsert_with_retry(destination_container, item, limiter, retry_deadline, backoff_base, backoff_cap)
+                progress.update(1)
+
+                stats = page_stats[page_no]
+                stats["ok" if transferred else "failed"] += 1
+                if retries:
+                    stats["retried"] += 1
+                stats["pending"] -= 1
+                if stats["pending"] == 0:
+                    await finish_page(page_no)
+
+        # Log lines are written through tqdm so they don't break up the progress bar
+        with logging_redirect_tqdm():
+            await asyncio.gather(produce(), *[consume() for _ in range(num_workers)])
+        progress.close()
+
+        if failed_items:
+            logger.warning("Partial transfer: %d items failed, rerun to resume from the first page with failures (%s kept)",
+                           failed_items, checkpoint_file)
+        elif os.path.exists(checkpoint_file):
+            # Everything was transferred, the next run should start from the beginning
+            os.remove(checkpoint_file)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())